@@ -10,13 +10,400 @@ parameters. The following files are saved:
       similarity ratio and proportion of satisfied occupants.
 """
 
-from copy import deepcopy
-from itertools import cycle, islice, product
-import random
+from itertools import product
+import warnings
+import zlib
 
-from matplotlib.animation import FuncAnimation, PillowWriter
+from matplotlib import font_manager
+from matplotlib.colors import to_rgb
 import matplotlib.pyplot as plt
+from numba import njit, prange
 import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from scipy.ndimage import convolve
+
+
+@njit(cache=True)
+def _satisfied(same, total, threshold):
+    """Determine whether an occupant is satisfied with their neighbours.
+    See Schelling.is_satisfied.
+    
+    Args:
+        same: Number of neighbours of the same race as the occupant.
+        total: Number of occupied neighbouring grid squares.
+        threshold: The similarity threshold.
+    
+    Returns:
+        True if the occupant is satisfied, False if unsatisfied.
+    """
+    # An occupant with no neighbours is considered satisfied.
+    return total == 0 or same / total >= threshold
+
+
+@njit(cache=True)
+def _histogram(grid_flat, same, total):
+    """Count the occupants with each combination of neighbour counts.
+    
+    Args:
+        grid_flat: Flattened city array.
+        same: Number of neighbours of the same race as the occupant of
+            each grid square.
+        total: Number of occupied neighbours of each grid square.
+    
+    Returns:
+        A (9, 9) array where element [t, s] is the number of occupants 
+        with t occupied neighbours, s of which are of the same race.
+    """
+    hist = np.zeros((9, 9), dtype=np.int64)
+    for i in range(grid_flat.shape[0]):
+        if grid_flat[i] >= 0:
+            hist[total[i], same[i]] += 1
+    return hist
+
+
+@njit(cache=True)
+def _tally(grid_flat, same, total, hist, cells, sign):
+    """Add (sign=1) or remove (sign=-1) the occupants of the given grid
+    squares from the histogram.
+    """
+    for i in cells:
+        if grid_flat[i] >= 0:
+            hist[total[i], same[i]] += sign
+
+
+@njit(cache=True)
+def _move(grid_flat, same, total, hist, nbr_idx, nbr_count, src, dst):
+    """Move the occupant of house src to the empty grid square dst. 
+    Only the neighbour counts of the grid squares around src and dst 
+    change, so these are updated locally along with the histogram.
+    
+    Args:
+        grid_flat: Flattened city array, updated in place.
+        same: Number of neighbours of the same race as the occupant of
+            each grid square, updated in place.
+        total: Number of occupied neighbours of each grid square, 
+            updated in place.
+        hist: Histogram of neighbour counts, see _histogram. Updated in
+            place.
+        nbr_idx: Neighbour index table, see Schelling.nbr_idx.
+        nbr_count: Number of neighbours of each grid square.
+        src: Flat index of the house to vacate.
+        dst: Flat index of the empty grid square to occupy.
+    """
+    race = grid_flat[src]
+    
+    # Vacate src.
+    nbrs = nbr_idx[src, :nbr_count[src]]
+    _tally(grid_flat, same, total, hist, nbrs, -1)
+    hist[total[src], same[src]] -= 1
+    grid_flat[src] = -1
+    same[src] = 0
+    for i in nbrs:
+        total[i] -= 1
+        if grid_flat[i] == race:
+            same[i] -= 1
+    _tally(grid_flat, same, total, hist, nbrs, 1)
+    
+    # Occupy dst.
+    nbrs = nbr_idx[dst, :nbr_count[dst]]
+    _tally(grid_flat, same, total, hist, nbrs, -1)
+    grid_flat[dst] = race
+    for i in nbrs:
+        total[i] += 1
+        if grid_flat[i] == race:
+            same[i] += 1
+            same[dst] += 1
+    hist[total[dst], same[dst]] += 1
+    _tally(grid_flat, same, total, hist, nbrs, 1)
+
+
+@njit(cache=True)
+def _n_unsatisfied(hist, threshold):
+    """Count the unsatisfied occupants from a histogram of neighbour 
+    counts, see _histogram. The cost is independent of the city size.
+    """
+    n_unsatisfied = 0
+    for t in range(1, hist.shape[0]):
+        for s in range(t + 1):
+            if not _satisfied(s, t, threshold):
+                n_unsatisfied += hist[t, s]
+    return n_unsatisfied
+
+
+@njit(cache=True)
+def _histogram_stats(hist, threshold):
+    """Calculate summary statistics from a histogram of neighbour 
+    counts, see _histogram.
+    
+    Returns:
+        A tuple of the mean similarity ratio of occupants with at least
+        one neighbour (nan if no occupant has a neighbour, as in 
+        Schelling.mean_similarity) and the proportion of satisfied 
+        occupants (1.0 if the city has no occupants).
+    """
+    ratio_sum = 0.0
+    n_with_neighbours = 0
+    for t in range(1, hist.shape[0]):
+        for s in range(t + 1):
+            ratio_sum += hist[t, s] * s / t
+            n_with_neighbours += hist[t, s]
+    n_occupants = hist.sum()
+    
+    # Numba raises ZeroDivisionError rather than returning nan.
+    mean_similarity = np.nan
+    if n_with_neighbours > 0:
+        mean_similarity = ratio_sum / n_with_neighbours
+    proportion_satisfied = 1.0
+    if n_occupants > 0:
+        n_unsatisfied = _n_unsatisfied(hist, threshold)
+        proportion_satisfied = 1 - n_unsatisfied / n_occupants
+    return mean_similarity, proportion_satisfied
+
+
+@njit(cache=True)
+def _step(grid_flat, same, total, hist, nbr_idx, nbr_count, 
+          occupied_houses, empty_houses, threshold):
+    """Move the first unsatisfied occupant of a shuffled list of all 
+    occupants to a randomly selected unoccupied house. At least one 
+    occupant must be unsatisfied.
+    
+    Note: In this setup, an occupant could move to a location they
+        are unsatisfied with. The way they move could be set up to 
+        avoid this. It could also include other rules such as moving
+        to the nearest location.
+    
+    Args:
+        grid_flat: Flattened city array, updated in place.
+        same: Number of neighbours of the same race as the occupant of
+            each grid square, updated in place.
+        total: Number of occupied neighbours of each grid square, 
+            updated in place.
+        hist: Histogram of neighbour counts, see _histogram. Updated in
+            place.
+        nbr_idx: Neighbour index table, see Schelling.nbr_idx.
+        nbr_count: Number of neighbours of each grid square.
+        occupied_houses: Flat indices of the occupied grid squares, 
+            updated in place.
+        empty_houses: Flat indices of the empty grid squares, updated 
+            in place.
+        threshold: The similarity threshold.
+    
+    Returns:
+        A tuple of the flat indices of the vacated and the newly 
+        occupied house.
+    """
+    # Fisher-Yates shuffle which stops as soon as an unsatisfied 
+    # occupant is drawn, so only the inspected prefix is shuffled.
+    n_occupied = occupied_houses.shape[0]
+    for k in range(n_occupied):
+        j = np.random.randint(k, n_occupied)
+        house = occupied_houses[j]
+        occupied_houses[j] = occupied_houses[k]
+        occupied_houses[k] = house
+        if not _satisfied(same[house], total[house], threshold):
+            # Exactly one grid square is filled and one emptied, so the
+            # vacated house and the chosen empty house swap places in 
+            # the index arrays.
+            j = np.random.randint(empty_houses.shape[0])
+            empty_house = empty_houses[j]
+            empty_houses[j] = house
+            occupied_houses[k] = empty_house
+            _move(grid_flat, same, total, hist, nbr_idx, nbr_count, house, 
+                  empty_house)
+            return house, empty_house
+    return -1, -1
+
+
+@njit(cache=True)
+def _run_until_satisfied(grid_flat, same, total, nbr_idx, nbr_count, 
+                         occupied_houses, empty_houses, threshold, limit, 
+                         deltas, stats, seed):
+    """Run the update step until either all occupants are satisfied or 
+    the update limit has been reached.
+    
+    Args:
+        grid_flat: Flattened city array, updated in place.
+        same: Number of neighbours of the same race as the occupant of
+            each grid square, updated in place.
+        total: Number of occupied neighbours of each grid square, 
+            updated in place.
+        nbr_idx: Neighbour index table, see Schelling.nbr_idx.
+        nbr_count: Number of neighbours of each grid square.
+        occupied_houses: Flat indices of the occupied grid squares, 
+            updated in place.
+        empty_houses: Flat indices of the empty grid squares, updated 
+            in place.
+        threshold: The similarity threshold.
+        limit: The update limit.
+        deltas: Preallocated int32 array of shape (update limit, 3). 
+            Row i is set to the vacated house, the newly occupied house
+            and the race of the occupant moved in update i + 1. Pass an
+            empty array to skip recording the updates.
+        stats: Preallocated float64 array of shape 
+            (update limit + 1, 2). Row i is set to the mean similarity 
+            ratio and the proportion of satisfied occupants after 
+            update i, row 0 holding those of the initial city. Pass an
+            empty array to skip recording the statistics.
+        seed: Seed for Numba's random number generator.
+    
+    Returns:
+        The number of updates.
+    """
+    np.random.seed(seed)
+    record_deltas = deltas.shape[0] > 0
+    record_stats = stats.shape[0] > 0
+    hist = _histogram(grid_flat, same, total)
+    if record_stats:
+        stats[0, 0], stats[0, 1] = _histogram_stats(hist, threshold)
+    n_updates = 0
+    while n_updates < limit and _n_unsatisfied(hist, threshold) > 0:
+        src, dst = _step(grid_flat, same, total, hist, nbr_idx, nbr_count, 
+                         occupied_houses, empty_houses, threshold)
+        if record_deltas:
+            deltas[n_updates, 0] = src
+            deltas[n_updates, 1] = dst
+            deltas[n_updates, 2] = grid_flat[dst]
+        n_updates += 1
+        if record_stats:
+            stats[n_updates, 0], stats[n_updates, 1] = _histogram_stats(
+                hist, threshold)
+    return n_updates
+
+
+# Byte patterns used to compare the eight neighbours of a grid square
+# at once, packed one byte each into a uint64 (SWAR).
+_ONES = np.uint64(0x0101010101010101)
+_LOW_BITS = np.uint64(0x7F7F7F7F7F7F7F7F)
+_EMPTY_WORD = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+@njit(cache=True)
+def _count_zero_bytes(word):
+    """Count the bytes of a uint64 which are zero.
+    
+    Unlike the common (word - 0x01...) & ~word & 0x80... test, this is 
+    exact for every byte as no carry or borrow crosses a byte boundary.
+    """
+    high_bits = ~(((word & _LOW_BITS) + _LOW_BITS) | word | _LOW_BITS)
+    
+    # Each zero byte now has only its high bit set. Move these to the 
+    # low bit and sum all bytes into the top byte.
+    return ((high_bits >> np.uint64(7)) * _ONES) >> np.uint64(56)
+
+
+@njit(cache=True)
+def _neighbour_counts(grid_flat, nbr_idx, nbr_count):
+    """Count the neighbours of every grid square. Equivalent to 
+    Schelling._compute_counts, for use inside other kernels.
+    
+    The races of the (up to eight) neighbours are packed into a single
+    uint64, one byte each, with empty and missing neighbours as 0xFF. A
+    byte matches the occupant's race exactly when it is zero after 
+    XOR-ing with the race repeated in every byte, so both counts take a
+    handful of 64-bit operations rather than eight comparisons. This 
+    requires at most 8 races, as there are only 8 colours.
+    
+    Args:
+        grid_flat: Flattened city array.
+        nbr_idx: Neighbour index table, see Schelling.nbr_idx.
+        nbr_count: Number of neighbours of each grid square.
+    
+    Returns:
+        A tuple of two int32 arrays: the number of neighbours of the 
+        same race as the occupant (0 for empty grid squares) and the 
+        total number of occupied neighbours of each grid square.
+    """
+    n_squares = grid_flat.shape[0]
+    same = np.zeros(n_squares, dtype=np.int32)
+    total = np.zeros(n_squares, dtype=np.int32)
+    for i in range(n_squares):
+        word = _EMPTY_WORD
+        for k in range(nbr_count[i]):
+            shift = np.uint64(8 * k)
+            neighbour = np.uint64(np.uint8(grid_flat[nbr_idx[i, k]]))
+            word = (word & ~(np.uint64(0xFF) << shift)) | (neighbour << shift)
+        
+        total[i] = 8 - _count_zero_bytes(word ^ _EMPTY_WORD)
+        race = grid_flat[i]
+        if race >= 0:
+            same[i] = _count_zero_bytes(word ^ (np.uint64(race) * _ONES))
+    return same, total
+
+
+@njit(cache=True, parallel=True)
+def _batch(grids, nbr_idx, nbr_count, threshold, limit, seeds):
+    """Run independent simulations in parallel, one per row of grids.
+    
+    Args:
+        grids: Array of flattened initial city arrays, one per 
+            replicate. Each row is updated in place.
+        nbr_idx: Neighbour index table, see Schelling.nbr_idx.
+        nbr_count: Number of neighbours of each grid square.
+        threshold: The similarity threshold.
+        limit: The update limit.
+        seeds: Seed for Numba's random number generator for each 
+            replicate.
+    
+    Returns:
+        A tuple of the number of updates of each replicate and an array
+        with the final mean similarity ratio and proportion of 
+        satisfied occupants of each replicate.
+    """
+    n_replicates = grids.shape[0]
+    updates = np.zeros(n_replicates, dtype=np.int64)
+    final_stats = np.empty((n_replicates, 2))
+    
+    # Nothing is recorded per update, only the final state is needed.
+    no_deltas = np.empty((0, 3), dtype=np.int32)
+    no_stats = np.empty((0, 2))
+    
+    # Each thread only modifies the row of its own replicate.
+    for r in prange(n_replicates):
+        grid_flat = grids[r]
+        same, total = _neighbour_counts(grid_flat, nbr_idx, nbr_count)
+        updates[r] = _run_until_satisfied(
+            grid_flat, same, total, nbr_idx, nbr_count, 
+            np.nonzero(grid_flat >= 0)[0], np.nonzero(grid_flat < 0)[0], 
+            threshold, limit, no_deltas, no_stats, seeds[r])
+        hist = _histogram(grid_flat, same, total)
+        final_stats[r, 0], final_stats[r, 1] = _histogram_stats(
+            hist, threshold)
+    return updates, final_stats
+
+
+def _kernel_hash():
+    """Hash the source code of the kernels, i.e. this module up to the
+    Schelling class. compile_kernels.py stores the hash in the compiled
+    module so that a build from older kernels can be detected.
+    
+    Returns:
+        The CRC-32 checksum of the kernel source.
+    """
+    with open(__file__, encoding="utf-8") as f:
+        source = f.read()
+    return zlib.crc32(source[:source.index("\nclass Schelling")].encode())
+
+
+# Use the ahead-of-time compiled kernel if it has been built with 
+# compile_kernels.py from the current kernels, which avoids compiling it
+# on first use. The compiled module is not tracked by git, so it is 
+# ignored with a warning if the kernels have changed since it was built.
+try:
+    import schelling_kernels
+except ImportError:
+    _run_kernel = _run_until_satisfied
+else:
+    # Builds from before the hash was added have no kernel_hash.
+    built_hash = getattr(schelling_kernels, "kernel_hash", lambda: None)()
+    if built_hash == _kernel_hash():
+        _run_kernel = schelling_kernels.run_until_satisfied
+    else:
+        warnings.warn(
+            "schelling_kernels was built from different kernels, using "
+            "the JIT-compiled kernel instead. Run compile_kernels.py to "
+            "rebuild it."
+        )
+        _run_kernel = _run_until_satisfied
 
 
 class Schelling:
@@ -36,40 +423,66 @@ class Schelling:
             limit is placed on the number of updates to prevent it 
             running indefinitely.
         races (int): Number of races.
+        seed (int): Optional seed for the random number generator, to
+            make a simulation reproducible.
     """
     
     def __init__(self, width, height, empty_ratio, similarity_threshold, 
-                 update_limit, races) :
+                 update_limit, races, seed=None) :
         self.width = width
         self.height = height
         self.empty_ratio = empty_ratio
         self.similarity_threshold = similarity_threshold
         self.update_limit = update_limit
         self.races = races
-        self.animation_frames = []
+        self.rng = np.random.default_rng(seed)
         self.colours = {0: "royalblue", 1: "orange", 2: "tomato", 3: "green",
                         4: "blueviolet", 5: "skyblue", 6: "darkslategrey", 
                         7: "pink"}
-        
+        self.grid_squares = list(product(range(width), range(height)))
+        
+        # The grid is static, so the flat indices (x * height + y) of 
+        # each grid square's neighbours are computed once. Rows are 
+        # padded with -1 for grid squares at the edge of the city which
+        # have fewer than eight neighbours.
+        self.nbr_idx = np.full((width * height, 8), -1, dtype=np.int32)
+        self.nbr_count = np.zeros(width * height, dtype=np.int8)
+        for x, y in self.grid_squares:
+            house = x * height + y
+            for i, j in product([x - 1, x, x + 1], [y - 1, y, y + 1]):
+                if (i, j) != (x, y) and 0 <= i < width and 0 <= j < height:
+                    self.nbr_idx[house, self.nbr_count[house]] = i * height + j
+                    self.nbr_count[house] += 1
+        
+    def _random_city(self, rng):
+        """Randomly place the required number of houses on the city 
+        grid, using the generator rng, and assign a race to each 
+        occupant. See populate.
+        """
+        n_squares = self.width * self.height
+        n_houses = int(n_squares * (1 - self.empty_ratio))
+        houses = rng.permutation(n_squares)[:n_houses]
+        city = np.full((self.width, self.height), -1, dtype=np.int8)
+        city.flat[houses] = np.arange(n_houses) % self.races
+        return city
+    
     def populate(self):
         """Randomly populates the city grid with the required number of 
         houses and assigns a race to each occupant.
         
         Returns:
-            A dictionary where the keys are the coordinates for the 
-            houses and the values represent the race of the occupant.
+            A 2D int8 array of shape (width, height) where each element
+            is the race of the occupant of that grid square, or -1 if
+            the grid square is empty.
             e.g.:
-            {(1,1): 0, (4,5): 1, (3,6): 0}
+            [[ 0, -1,  1],
+             [-1,  1,  0]]
         """
-        self.grid_squares = list(product(range(self.width), range(self.height)))
-        random.shuffle(self.grid_squares)
-        n_houses = int(len(self.grid_squares) * (1 - self.empty_ratio))
-        houses = self.grid_squares[:n_houses]
-        races = list(islice(cycle(range(self.races)), n_houses))
-        city = dict(zip(houses, races))
+        city = self._random_city(self.rng)
         
-        # Add the initial distribution to the animation frame list.
-        self.animation_frames.append(deepcopy(city))
+        # Keep the initial distribution, the animation frames are 
+        # reconstructed from it by replaying the recorded updates.
+        self.initial_city = city.copy()
         
         return city
     
@@ -84,127 +497,203 @@ class Schelling:
                 neighbours is to be returned.
         
         Returns:
-            A list of coordinates for neighbouring grid squares.
+            An array of flat indices (x * height + y) of neighbouring 
+            grid squares.
         """
         x,y = house
-        surrounding = product([x - 1, x, x + 1], [y - 1, y, y + 1])
-        neighbours = [i for i in surrounding if i in self.grid_squares]
-        neighbours.remove((x,y))
-        return neighbours
-    
-    def is_satisfied(self, city, house):
-        """Determine whether an occupant of a house is satisfied with 
-        their neighbours. An occupant is satisfied if the ratio of 
-        neighbours of the same race to neighbours of a different race is
-        greater than or equal to their similarity threshold.
-            
+        flat_idx = x * self.height + y
+        return self.nbr_idx[flat_idx, :self.nbr_count[flat_idx]]
+    
+    def _compute_counts(self, city):
+        """Count the neighbours of every grid square at once by 
+        convolving the city grid with a 3x3 kernel which excludes the 
+        centre square.
+        
         Args:
-            city: Dictionary containing all currently occupied houses.
-            house: The location of occupant to check satisfied status 
-                of.
+            city: Array containing the race of the occupant of each 
+                grid square, -1 for empty grid squares.
         
         Returns:
-            True if the occupant is satisfied, False if unsatisfied.
+            A tuple of two int32 arrays with the same shape as the city:
+            the number of neighbours of the same race as the occupant 
+            (0 for empty grid squares) and the total number of occupied 
+            neighbouring grid squares.
         """
-        occupant_race = city[house]
-        neighbours = self.get_neighbours(house)
+        kernel = np.ones((3, 3), dtype=np.int32)
+        kernel[1, 1] = 0
+        
+        total = convolve((city >= 0).astype(np.int32), kernel, mode='constant')
+        same = np.zeros(city.shape, dtype=np.int32)
+        for race in range(self.races):
+            is_race = city == race
+            race_counts = convolve(is_race.astype(np.int32), kernel, 
+                                   mode='constant')
+            same[is_race] = race_counts[is_race]
+        
+        return same, total
+    
+    def is_satisfied(self, city):
+        """Determine whether each occupant is satisfied with their 
+        neighbours. An occupant is satisfied if the ratio of neighbours 
+        of the same race to neighbours of a different race is greater 
+        than or equal to their similarity threshold.
+            
+        Args:
+            city: Array containing the race of the occupant of each 
+                grid square, -1 for empty grid squares.
         
-        same_race = sum(1 for i in neighbours 
-                        if i in city and city[i] == occupant_race)
-        other_race = sum(1 for i in neighbours 
-                         if i in city and city[i] != occupant_race)
+        Returns:
+            A boolean array with the same shape as the city, True where
+            the occupant is satisfied and False where the occupant is 
+            unsatisfied or the grid square is empty.
+        """
+        same, total = self._compute_counts(city)
         
         # Avoid division by 0. In this case an occupant with no 
         # neighbours is considered satisfied. 
-        if same_race + other_race == 0:
-            return True
-        
-        if same_race / (same_race + other_race) < self.similarity_threshold:
-            return False
-        else :
-            return True
+        satisfied = ((same / np.maximum(total, 1) >= self.similarity_threshold)
+                     | (total == 0))
+        return satisfied & (city >= 0)
         
     def all_satisfied(self, city):
         """
         Args:
-            city: Dictionary containing all currently occupied houses.
+            city: Array containing the race of the occupant of each 
+                grid square, -1 for empty grid squares.
         
         Returns:
             True if all city inhabitants are satisfied.
         """
-        return all(self.is_satisfied(city, house) for house in city)
+        return self.is_satisfied(city)[city >= 0].all()
     
-    def update(self, city, house):
-        """Move an unsatisfied occupant to a randomly selected
-        unoccupied house. The updated city dictionary is added to
-        the list of animation frames.
+    def run(self):
+        """Run the model simulation. Call the populate function and then
+        move unsatisfied occupants until either all inhabitants are 
+        satisfied or the update limit has been reached. Each update is 
+        recorded in self.deltas as the vacated house, the newly occupied
+        house and the race of the occupant, and the mean similarity 
+        ratio and proportion of satisfied occupants after each update 
+        are recorded in self.sim_stats.
+        """
+        city = self.populate()
         
-        Note: In this setup, an occupant could move to a location they
-            are unsatisfied with. The way they move could be set up to 
-            avoid this. It could also include other rules such as moving
-            to the nearest location.
+        # The neighbour counts are computed once for the whole city and
+        # then updated locally by the kernel after each move. The 
+        # ravelled arrays are views, so city is updated in place.
+        same, total = self._compute_counts(city)
+        
+        # Fresh buffers sized to the update limit are allocated on every
+        # run, as the kernel does not check bounds and the recorded 
+        # arrays are trimmed to the updates actually made.
+        deltas = np.empty((self.update_limit, 3), dtype=np.int32)
+        sim_stats = np.empty((self.update_limit + 1, 2))
+        self.total_updates = _run_kernel(
+            city.ravel(),
+            same.ravel(),
+            total.ravel(),
+            self.nbr_idx,
+            self.nbr_count,
+            np.flatnonzero(city >= 0),
+            np.flatnonzero(city < 0),
+            self.similarity_threshold,
+            self.update_limit,
+            deltas,
+            sim_stats,
+            # The kernel uses Numba's own generator, seeded from 
+            # self.rng so the whole simulation follows from one seed.
+            self.rng.integers(2 ** 31 - 1),
+        )
+        self.deltas = deltas[:self.total_updates]
+        self.sim_stats = sim_stats[:self.total_updates + 1]
+        self.final_city = city
+    
+    def run_batch(self, n_replicates, seeds=None):
+        """Run many independent simulations with the model's parameters
+        in parallel across all available cores, e.g. to collect 
+        statistics such as those in simulation_data.csv. Nothing is 
+        recorded for the animation or plots.
         
         Args:
-            city: Dictionary containing all currently occupied houses.
-            house: The location of the occupant to update location of.
+            n_replicates: Number of simulations to run.
+            seeds: Optional sequence of n_replicates seeds, one per 
+                simulation. By default they are drawn from self.rng. A
+                simulation with seed s is the same as running a model 
+                created with seed=s.
         
         Returns:
-            Updated dictionary containing all occupied houses.
+            A tuple of two arrays with the total number of updates and 
+            the final mean similarity ratio, rounded to 2 decimal 
+            places, of each simulation.
         """
-        empty_house = random.choice(
-            [square for square in self.grid_squares if square not in city])
-        city[empty_house] = city[house]
-        del city[house]
-        self.animation_frames.append(deepcopy(city))
-        return city
+        if seeds is None:
+            seeds = self.rng.integers(2 ** 31 - 1, size=n_replicates)
+        
+        # Draw each initial city and kernel seed in the same order as 
+        # populate and run.
+        rngs = [np.random.default_rng(seed) for seed in seeds]
+        grids = np.stack([self._random_city(rng).ravel() for rng in rngs])
+        kernel_seeds = np.array([rng.integers(2 ** 31 - 1) for rng in rngs])
+        
+        updates, final_stats = _batch(
+            grids,
+            self.nbr_idx,
+            self.nbr_count,
+            self.similarity_threshold,
+            self.update_limit,
+            kernel_seeds,
+        )
+        return updates, np.round(final_stats[:, 0], 2)
     
-    def run(self):
-        """Run the model simulation. Call the populate function and then
-        run the update function until either all inhabitants are 
-        satisfied or the update limit has been reached.
+    def iter_frames(self):
+        """Reconstruct the frames of the simulation by replaying the 
+        recorded updates from the initial distribution.
+        
+        Yields:
+            The city array after each update, starting with the initial
+            distribution. The same array is updated in place and 
+            yielded for every frame, so it must be copied to be kept.
         """
-        update_count = 0
-        city = self.populate()
-        
-        while not self.all_satisfied(city) and update_count < self.update_limit:
-            occupied_houses = list(city)
-            random.shuffle(occupied_houses)
-            for house in occupied_houses:
-                if not self.is_satisfied(city, house):
-                    city = self.update(city, house)
-                    update_count += 1
-                    break
-        
-        self.total_updates = len(self.animation_frames) - 1
+        city = self.initial_city.copy()
+        grid_flat = city.ravel()
+        yield city
+        for src, dst, race in self.deltas:
+            grid_flat[src] = -1
+            grid_flat[dst] = race
+            yield city
         
     def mean_similarity(self, city):
         """Calculate the mean similarity ratio of occupants in a given 
         frame of the simulation.
         
         Args:
-            city: Dictionary containing all currently occupied houses.
+            city: Array containing the race of the occupant of each 
+                grid square, -1 for empty grid squares.
 
         Returns:
             Mean similarity ratio, rounded to 2 decimal places.
         """
-        results = []
-        for house in city:
-            neighbours = self.get_neighbours(house)
-
-            same_race = sum(1 for i in neighbours 
-                            if i in city and city[i] == city[house])
-            other_race = sum(1 for i in neighbours 
-                             if i in city and city[i] != city[house])
-
-            # If a similarity ratio cannot be calculated, nothing is 
-            # appended. Undecided if this is the best.
-            if same_race + other_race == 0:
-                pass
-            else:
-                results.append(same_race / (same_race + other_race))
-
-        return round(np.mean(results), 2)
+        same, total = self._compute_counts(city)
+        
+        # If a similarity ratio cannot be calculated, the occupant is 
+        # excluded. Undecided if this is the best.
+        has_neighbours = (city >= 0) & (total > 0)
+        
+        return round(np.mean(same[has_neighbours] / total[has_neighbours]), 2)
+        
+    def colour_lut(self):
+        """Build a lookup table from grid square values to colours, so 
+        a whole city array can be coloured with a single indexing 
+        operation, e.g. colour_lut()[city + 1].
         
+        Returns:
+            A (races + 1, 3) array of RGB colours in the range 0-1. Row 0
+            is white for empty grid squares and row race + 1 is the 
+            colour of that race.
+        """
+        return np.array(
+            [to_rgb("white")] 
+            + [to_rgb(self.colours[race]) for race in range(self.races)])
+    
     def plot_initial_final(self, filename_label):
         """Save two png files, one conatining the intial distribution of
         inhabitants, the second containing the distribution once the 
@@ -215,7 +704,7 @@ class Schelling:
                 'Schelling_initial_{label}.png' and 
                 'Schelling_final_{label}.png'.
         """
-        frames = [self.animation_frames[0], self.animation_frames[-1]]
+        frames = [self.initial_city, self.final_city]
         titles = ["Initial Distribution", "Final Distribution"]
         filenames = ["Schelling_initial_{}.png", "Schelling_final_{}.png"]
         
@@ -235,47 +724,50 @@ class Schelling:
             "Final mean similarity - {}".format(final_mean_similarity),
         ]
         
-        for frame, title, filename in zip(frames, titles, filenames):
-            x = [x + 0.5 for x,y in frame]
-            y = [y + 0.5 for x,y in frame]
-            colour_list = [self.colours[frame[i]] for i in frame]
-            
-            fig = plt.figure(figsize=(15 * self.width / self.height * 1.5, 15))
-            plt.axes(xlim=(0, self.width), ylim=(0, self.height))
-            plt.xticks([])
-            plt.yticks([])
-            plt.subplots_adjust(right=0.66)
-            
-            for yc, anno_text in zip(y_coordinates, annotation_texts):
-                plt.text(
-                    x=self.width * 1.1, 
-                    y=self.height * yc, 
-                    s=anno_text, 
-                    font=dict(size=30)
-                )
-            
+        # The figure and annotations are created once and only the grid
+        # and title are changed between the two saved images.
+        fig = plt.figure(figsize=(15 * self.width / self.height * 1.5, 15))
+        plt.axes(xlim=(0, self.width), ylim=(0, self.height))
+        plt.xticks([])
+        plt.yticks([])
+        plt.subplots_adjust(right=0.66)
+        
+        for yc, anno_text in zip(y_coordinates, annotation_texts):
             plt.text(
-                x=0,
-                y=self.height + 0.5,
-                s=title,
-                font=dict(size=40),
-                horizontalalignment="left",
+                x=self.width * 1.1, 
+                y=self.height * yc, 
+                s=anno_text, 
+                font=dict(size=30)
             )
         
-            # Not sure why this is needed by text is pixelated without 
-            # it.
-            fig.patch.set_facecolor('white')
-
-            plt.scatter(
-                x, y, 
-                s=min((0.5 * 15 * 72 / self.width) ** 2, 
-                      (0.5 * 15 * 72 / self.height) ** 2), 
-                marker='s',
-                c=colour_list
-            )
-            
-            plt.savefig(filename.format(filename_label), dpi=72)
-            plt.close()
+        title_text = plt.text(
+            x=0,
+            y=self.height + 0.5,
+            s=titles[0],
+            font=dict(size=40),
+            horizontalalignment="left",
+        )
+    
+        # Not sure why this is needed by text is pixelated without it.
+        fig.patch.set_facecolor('white')
+        
+        # One pixel per grid square, coloured with the lookup table and
+        # transposed so that x runs along the horizontal axis.
+        lut = self.colour_lut()
+        im = plt.imshow(
+            lut[frames[0].T + 1],
+            origin='lower',
+            extent=(0, self.width, 0, self.height),
+            interpolation='nearest',
+            aspect='auto',
+        )
+        
+        for frame, title, filename in zip(frames, titles, filenames):
+            im.set_data(lut[frame.T + 1])
+            title_text.set_text(title)
+            fig.savefig(filename.format(filename_label), dpi=72)
+        
+        plt.close()
             
     def create_GIF(self, filename_label):
         """Save a GIF to illustrate the simulation. Each frame shows the
@@ -285,16 +777,8 @@ class Schelling:
             filename_label: The GIF file is saved as 
                 'Schelling_{label}.gif'.
         """
-        x = [x for x,y in self.grid_squares]
-        y = [y for x,y in self.grid_squares]
-
-        positions = [[(x + 0.5, y + 0.5) for x,y in frame] 
-                     for frame in self.animation_frames]
-        colour_list = [[self.colours[frame[i]] for i in frame] 
-                       for frame in self.animation_frames]
-        
-        initial_mean_similarity = self.mean_similarity(self.animation_frames[0])
-        final_mean_similarity = self.mean_similarity(self.animation_frames[-1])
+        initial_mean_similarity = self.mean_similarity(self.initial_city)
+        final_mean_similarity = self.mean_similarity(self.final_city)
 
         # Title text for each frame of the animation.
         text = ["Update {} of {}".format(i, self.total_updates) 
@@ -316,8 +800,12 @@ class Schelling:
             "Final mean similarity - {}".format(final_mean_similarity),
         ]
         
-        fig = plt.figure(figsize=(15 * self.width / self.height * 1.5, 15))
-        plt.axes(xlim=(0, self.width), ylim=(0, self.height))
+        # The figure with the axes and annotations is only rendered 
+        # once by Matplotlib. Each frame is then composited with Pillow
+        # on top of this static background.
+        fig = plt.figure(figsize=(15 * self.width / self.height * 1.5, 15), 
+                         dpi=72)
+        ax = plt.axes(xlim=(0, self.width), ylim=(0, self.height))
         
         # Hide axis ticks.
         plt.xticks([])
@@ -336,45 +824,67 @@ class Schelling:
                 s=anno_text, 
                 font=dict(size=30)
             )
+        
+        fig.canvas.draw()
+        background = Image.fromarray(
+            np.asarray(fig.canvas.buffer_rgba())).convert("RGB")
+        fig_height = background.height
+        
+        # Pixel box inside the axes spines which the grid is drawn in.
+        x0, y0, x1, y1 = ax.get_window_extent().extents
+        grid_box = (round(x0) + 1, round(fig_height - y1) + 1, 
+                    round(x1) - 1, round(fig_height - y0) - 1)
+        grid_size = (grid_box[2] - grid_box[0], grid_box[3] - grid_box[1])
+        
+        # Position and font of the title, matching the Matplotlib text
+        # (left aligned on the baseline, 40pt at 72 dpi).
+        title_x, title_y = ax.transData.transform((0, self.height + 0.5))
+        title_anchor = (title_x, fig_height - title_y)
+        title_font = ImageFont.truetype(font_manager.findfont(None), 40)
+        plt.close()
+        
+        lut = (self.colour_lut() * 255).round().astype(np.uint8)
 
-        title_text = plt.text(
-            x=0,
-            y=self.height + 0.5,
-            s=text[0],
-            font=dict(size=40),
-            horizontalalignment="left",
-        )
-
-        scat = plt.scatter(
-            x, y, 
-            s=min((0.5 * 15 * 72 / self.width) ** 2, 
-                  (0.5 * 15 * 72 / self.height) ** 2), 
-            marker='s',
-        )
-
-        def animate(frame, data, points, text, scat):
-            """Set the position and colours of the house occupants in 
-            a given frame.
+        def render(i, frame):
+            """Composite the city and title of a given frame onto the 
+            static background.
             """
-            scat.set_offsets(points[frame])
-            scat.set_color(data[frame])
-            title_text.set_text(text[frame])
-            return scat,
-
-        anim = FuncAnimation(
-            fig, 
-            animate,
-            frames=self.total_updates + 1, 
-            interval=40,
-            fargs=(colour_list, positions, text, scat),
-            blit=True,
+            image = background.copy()
+            
+            # One pixel per grid square, flipped so that y increases up
+            # the image, then scaled up to the size of the axes.
+            grid = Image.fromarray(lut[frame.T[::-1] + 1])
+            image.paste(grid.resize(grid_size, Image.NEAREST), grid_box[:2])
+            
+            ImageDraw.Draw(image).text(
+                title_anchor, 
+                text[i], 
+                fill="black", 
+                font=title_font, 
+                anchor="ls",
+            )
+            return image
+
+        # Quantize every frame to the palette of the first frame, which
+        # contains all the colours used, rather than computing a new 
+        # palette per frame.
+        palette = render(0, self.initial_city).quantize(colors=256)
+        frames = (
+            render(i, frame).quantize(palette=palette, 
+                                      dither=Image.Dither.NONE)
+            for i, frame in enumerate(self.iter_frames())
         )
-        anim.save(
+        first_frame = next(frames)
+        first_frame.save(
             "Schelling_{}.gif".format(filename_label),
-            writer='pillow', 
-            dpi=72
+            save_all=True,
+            append_images=frames,
+            duration=40,
+            loop=0,
+            # The frames already share a palette, so skip Pillow's 
+            # per-frame palette optimisation.
+            optimize=False,
         )
-        plt.close()
         
     def plot_mean_similarity(self, filename_label):
         """Save a png with a two plots showing the development of the 
@@ -385,19 +895,16 @@ class Schelling:
             filename_label: The png file is saved as 
                 'Schelling_mean_similarity_{label}.png'.
         """
-        n_occupants = len(self.animation_frames[0])
-        mean_similarity = [self.mean_similarity(frame) 
-                           for frame in self.animation_frames]
-        percent_satisfied = [sum(self.is_satisfied(frame, house) 
-                                 for house in frame) / n_occupants 
-                             for frame in self.animation_frames]
+        # Both statistics are recorded during the simulation.
+        mean_similarity = np.round(self.sim_stats[:, 0], 2)
+        percent_satisfied = self.sim_stats[:, 1]
         
         fig = plt.figure(figsize=(10,6))
         
         subplot_1 = plt.subplot(1,2,1)
         plt.title("Mean Similarity Ratio After Each Update")
         plt.plot(
-            range(len(self.animation_frames)),
+            range(self.total_updates + 1),
             mean_similarity,
             c='royalblue',
         )
@@ -416,7 +923,7 @@ class Schelling:
         plt.subplot(1,2,2, sharey=subplot_1)
         plt.title("Proportion of Satisfied Occupants\nAfter Each Update")
         plt.plot(
-            range(len(self.animation_frames)),
+            range(self.total_updates + 1),
             percent_satisfied,
             c='tomato',
         )
@@ -0,0 +1,47 @@
+"""Script to compile the simulation kernel ahead of time.
+
+Numba compiles the simulation kernels the first time they are used.
+The compiled code is cached, but this still has to happen once on each
+machine and after every change to the kernels. Running this script
+builds the schelling_kernels extension module next to it, which 
+Schelling_animation.py imports in place of the JIT-compiled kernel for
+single simulations. The parallel batch kernel is always JIT-compiled, 
+as Numba cannot compile parallel code ahead of time.
+
+The module records a hash of the kernel source. If the kernels are 
+edited afterwards, Schelling_animation.py warns and falls back to the 
+JIT-compiled kernel until this script is run again.
+
+Usage:
+    python compile_kernels.py
+"""
+
+import os
+
+from numba.pycc import CC
+
+from Schelling_animation import _kernel_hash, _run_until_satisfied
+
+
+cc = CC("schelling_kernels")
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Argument types as passed by Schelling.run, see _run_until_satisfied.
+cc.export(
+    "run_until_satisfied",
+    "int64(int8[::1], int32[::1], int32[::1], int32[:, ::1], int8[::1], "
+    "int64[::1], int64[::1], float64, int64, int32[:, ::1], "
+    "float64[:, ::1], int64)",
+)(_run_until_satisfied.py_func)
+
+KERNEL_HASH = _kernel_hash()
+
+
+@cc.export("kernel_hash", "int64()")
+def kernel_hash():
+    """Hash of the kernel source this module was compiled from."""
+    return KERNEL_HASH
+
+
+if __name__ == "__main__":
+    cc.compile()